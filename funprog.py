@@ -7,7 +7,6 @@ Steve Martin
 __all__ = ["negate", "position", "compose"]
 
 from typing import Callable, Iterator
-from functools import reduce
 
 def negate(f: Callable[..., bool]) -> Callable[..., bool]:
     """
@@ -77,9 +76,20 @@ def compose(*f: Callable) -> Callable:
     6
     """
     
-    def circ(f, g):
-        return lambda x: f(g(x))
-    return reduce(circ, f)
+    if not f:
+        raise TypeError(
+            "compose() requires at least one function"
+            )
+    if len(f) == 1:
+        return f[0]
+    # Call the functions in a loop rather than nesting lambdas, so the
+    # composition costs one frame no matter how many functions there are
+    f = f[::-1]
+    def composed(x):
+        for g in f:
+            x = g(x)
+        return x
+    return composed
 
 if __name__ == "__main__":
     assert not negate(lambda x: x > 1)(2)
@@ -89,5 +99,13 @@ if __name__ == "__main__":
     def add(n):
         return lambda x: x + n
     assert compose(add(1), add(2), sum)(range(3)) == 6
+    assert compose(sum)(range(3)) == 3
+    assert compose(str, add(1))(1) == "2"
+    try:
+        compose()
+    except TypeError:
+        pass
+    else:
+        raise AssertionError("expected a TypeError")
 
     print("Passing all tests")
\ No newline at end of file
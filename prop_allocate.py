@@ -1,6 +1,19 @@
-from math import floor, fsum, sqrt
+from math import floor, fsum, inf, sqrt
 from collections import Counter
+from heapq import heapify, heapreplace
 from typing import Callable
+import numpy as np
+
+def _smallest(x: np.ndarray, k: int) -> np.ndarray:
+    # Positions of the k smallest values in x in linear time, with ties
+    # going to the earliest positions (as with a stable sort)
+    k = min(k, len(x))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    kth = np.partition(x, k - 1)[k - 1]
+    less = np.flatnonzero(x < kth)
+    tied = np.flatnonzero(x == kth)[:k - len(less)]
+    return np.concatenate([less, tied])
 
 def largest_remainder(size: dict[str, float], n: int) -> Counter[str, int]:
     """
@@ -33,24 +46,57 @@ def largest_remainder(size: dict[str, float], n: int) -> Counter[str, int]:
         raise ValueError(
             "n must be positive"
             )
-    if any(x < 0 for x in size.values()):
+    keys = list(size)
+    x = np.fromiter(size.values(), dtype=np.float64, count=len(keys))
+    if np.any(x < 0):
         raise ValueError(
             "size cannot have negative values"
             )
-    res, remainder, total = Counter(), dict(), 0
-    sumx = fsum(size.values())
+    # A pairwise sum is much faster than fsum() for many units, and its
+    # rounding error is too small to change the floors for realistic sizes
+    sumx = fsum(size.values()) if len(x) < 64 else x.sum()
     if sumx == 0:
         raise ValueError(
             "size cannot have all zeros"
             )
-    for k, x in size.items():
-        np = n * x / sumx
-        npf = floor(np)
-        res[k], remainder[k] = npf, npf - np
-        total += npf
-    add_one = sorted(remainder, key=remainder.get)[:n - total]
-    res.update(dict.fromkeys(add_one, 1))
-    return res
+    quota = n * x / sumx
+    npf = np.floor(quota)
+    add_one = _smallest(npf - quota, n - int(npf.sum()))
+    res = npf.astype(np.int64)
+    res[add_one] += 1
+    return Counter(dict(zip(keys, res.tolist())))
+
+def _adams(x: int) -> float:
+    return x
+
+def _dean(x: int) -> float:
+    return x * (x + 1) / (x + 0.5)
+
+def _huntington_hill(x: int) -> float:
+    return sqrt(x * (x + 1))
+
+def _webster(x: int) -> float:
+    return x + 0.5
+
+def _dhondt(x: int) -> float:
+    return x + 1
+
+def _imperiali(x: int) -> float:
+    return x + 2
+
+def _danish(x: int) -> float:
+    return x + 1 / 3
+
+# Named divisors are built once, so looking one up is a single dict access
+_divisors = {
+    "adams": _adams,
+    "dean": _dean,
+    "huntington-hill": _huntington_hill,
+    "webster": _webster,
+    "d'hondt": _dhondt,
+    "imperiali": _imperiali,
+    "danish": _danish
+    }
 
 def divisor(name: str) -> Callable[int, float]:
     """
@@ -75,24 +121,12 @@ def divisor(name: str) -> Callable[int, float]:
     [0.5, 1.5, 2.5, 3.5, 4.5]
     """
     
-    if name.lower() == "adams":
-        return lambda x: x
-    elif name.lower() == "dean":
-        return lambda x: x * (x + 1) / (x + 0.5)
-    elif name.lower() == "huntington-hill":
-        return lambda x: sqrt(x * (x + 1))
-    elif name.lower() == "webster":
-        return lambda x: x + 0.5
-    elif name.lower() == "d'hondt":
-        return lambda x : x + 1
-    elif name.lower() == "imperiali":
-        return lambda x: x + 2
-    elif name.lower() == "danish":
-        return lambda x: x + 1 / 3
-    else:
+    try:
+        return _divisors[name.lower()]
+    except KeyError:
         raise ValueError(
             "name must be one of Adams, Dean, Huntington-Hill, Webster, D'Hondt, Imperiali, or Danish"
-            )
+            ) from None
             
 def highest_average(
         size: dict[str, float], 
@@ -135,12 +169,29 @@ def highest_average(
         raise ValueError(
             "sizes cannot be negative"
             )
-    res = Counter(dict.fromkeys(size, 0))
+    def quotient(x, a):
+        d = divisor(a)
+        return x / d if d > 0 else inf
+    # Keep the quotients in a heap so that each seat only needs to update
+    # the quotient for the unit that gets it; the position breaks ties in
+    # favor of the first unit
+    keys, x = list(size), list(size.values())
+    res = [0] * len(keys)
+    # D'Hondt always gives a unit at least the floor of its quota, so most
+    # seats can be handed out up front without the heap (less one seat to
+    # allow for rounding error)
+    total = fsum(x)
+    if divisor is _dhondt and total > 0:
+        res = [max(floor(n * v / total) - 1, 0) for v in x]
+        n -= sum(res)
+    heap = [(-quotient(v, a), i) for i, (v, a) in enumerate(zip(x, res))]
+    heapify(heap)
     while n > 0:
-        td = {k: v / divisor(res[k]) for k, v in size.items()}
-        res[max(td, key=td.get)] += 1
+        i = heap[0][1]
+        res[i] += 1
+        heapreplace(heap, (-quotient(x[i], res[i]), i))
         n -= 1
-    return res
+    return Counter(dict(zip(keys, res)))
 
 def allocate(
         size: dict[str, float],
@@ -188,12 +239,10 @@ def allocate(
         raise ValueError(
             f"initial allocation cannot be larger than {int(initial/len(size))}"
             )
-    res = Counter(dict.fromkeys(size, initial))
+    res = dict.fromkeys(size, initial)
     if units is None:
-        units = Counter(dict.fromkeys(res, n))
-    elif set(size) == set(units):
-        units = Counter(units)
-    else:
+        units = dict.fromkeys(res, n)
+    elif set(size) != set(units):
         raise ValueError(
             "size and units must have the same keys"
             )
@@ -201,16 +250,19 @@ def allocate(
         raise ValueError(
             "units cannot have negative values"
             )
-    n -= initial * len(size)
-    while n > 0:
-        res.update(method(size, n))
-        n = 0
-        for k, v in res.items():
-            if v > units[k]:
+    # Only units that haven't hit their limit take part in rounding
+    active = dict(size)
+    remaining = n - initial * len(size)
+    while remaining > 0:
+        for k, v in method(active, remaining).items():
+            res[k] += v
+        remaining = 0
+        for k in list(active):
+            if res[k] > units[k]:
+                remaining += res[k] - units[k]
                 res[k] = units[k]
-                n += v - units[k]
-                size[k] = 0
-    return res
+                del active[k]
+    return Counter(res)
 
 if __name__ == "__main__":
     assert largest_remainder({"a": 1, "c": 1, "b": 1}, 0) == {"a": 0, "c": 0, "b": 0}
@@ -221,6 +273,16 @@ if __name__ == "__main__":
     assert largest_remainder({"a": 0.25, "b": 0.2, "c": 0.4, "d": 0.15}, 10) == {"a": 3, "b": 2, "c": 4, "d": 1}
     assert largest_remainder({"a": 0.25, "b": 0.2, "c": 0.4, "d": 0.15}, 4) == {"a": 1, "b": 1, "c": 2, "d": 0}
     assert largest_remainder({"a": 25, "b": 20, "c": 40, "d": 15, "e": 0}, 4) == {"a": 1, "b": 1, "c": 2, "d": 0, "e": 0}
+    # Partial selection keeps ties in key order
+    assert largest_remainder(dict.fromkeys("abcdefghij", 1), 3) == dict(zip("abcdefghij", [1] * 3 + [0] * 7))
+    assert largest_remainder({"a": 1, "b": 2, "c": 1, "d": 2, "e": 1}, 4) == {"a": 1, "b": 1, "c": 1, "d": 1, "e": 0}
+    assert highest_average({"a": 6 / 14, "b": 6 / 14, "c": 2 / 14}, 10) == {"a": 5, "b": 4, "c": 1}
+    assert highest_average({"a": 6 / 14, "b": 6 / 14, "c": 2 / 14}, 10, divisor=divisor("Webster")) == {"a": 5, "b": 4, "c": 1}
+    # Named divisors are shared
+    assert divisor("Webster") is divisor("webster")
+    assert highest_average({"a": 6 / 14, "b": 6 / 14, "c": 2 / 14}, 11, divisor=divisor("d'hondt")) == {"a": 5, "b": 5, "c": 1}
+    # Zero divisor for the first seat
+    assert highest_average({"a": 6 / 14, "b": 6 / 14, "c": 2 / 14}, 3, divisor=divisor("Adams")) == {"a": 1, "b": 1, "c": 1}
     # Alabama paradox
     assert allocate({"a": 6 / 14, "b": 6 / 14, "c": 2 / 14}, 10) == {"a": 4, "b": 4, "c": 2}
     assert allocate({"a": 6 / 14, "b": 6 / 14, "c": 2 / 14}, 11) == {"a": 5, "b": 5, "c": 1}
@@ -1,5 +1,6 @@
 import numpy as np
 from collections import Counter
+from math import inf
 from typing import Callable
 
 """
@@ -10,9 +11,21 @@ __all__ = [
     "pi",
     "sps",
     "ps",
+    "PoissonSampler",
     "allocate"
 ]
 
+def _as_f64_flat(a: np.ndarray) -> np.ndarray:
+    # Avoid a copy when a is already a flat float64 array
+    if (
+        isinstance(a, np.ndarray) and
+        a.ndim == 1 and
+        a.dtype == np.float64 and
+        a.flags.c_contiguous
+    ):
+        return a
+    return np.ascontiguousarray(a, dtype=np.float64).reshape(-1)
+
 def _pi(
     x: np.ndarray, 
     n: int
@@ -44,19 +57,48 @@ def pi(
     >>> pi([1, 3, 30, 100], 3)
     array([0.25, 0.75, 1.  , 1.  ])
     """
-    x = np.asfarray(x).ravel()
+    x = _as_f64_flat(x)
     res = _pi(x, n)
     if np.max(res) <= 1:
         return res
-    while True:
-        ts = np.flatnonzero(res < 1)
-        n_ts = n - len(x) + len(ts)
-        p = _pi(x[ts], n_ts)
-        res[ts] = p
-        if np.max(p) <= 1:
-            break
+    # Sort once and find the number of units k to take with certainty:
+    # the smallest k for which the (k + 1)-th largest unit has an
+    # inclusion probability no greater than 1 among the remaining units
+    order = np.argsort(-x, kind="stable")
+    xs = x[order]
+    tail = np.cumsum(xs[::-1])[::-1]
+    k = np.flatnonzero(xs * (n - np.arange(len(xs))) <= tail)
+    res = np.ones_like(x)
+    if len(k) > 0:
+        ts = order[k[0]:]
+        res[ts] = _pi(x[ts], n - k[0])
     return np.minimum(res, 1)
 
+def _sps_core(
+    ratio: np.ndarray,
+    n_ts: int,
+    ta: np.ndarray,
+    ts: np.ndarray
+) -> np.ndarray:
+    # ratio is prn / pi for the units in ts along the last axis; ta and ts
+    # are the (sorted) indexes for the take-all and take-some units
+    if n_ts > 0:
+        keep = np.argpartition(ratio, n_ts - 1, axis=-1)[..., :n_ts]
+        keep = np.sort(ts[keep], axis=-1)
+    else:
+        keep = np.empty(ratio.shape[:-1] + (0,), dtype=ts.dtype)
+    if len(ta) == 0:
+        return keep
+    # Both ta and keep are sorted, so merge them rather than sorting again
+    pos = np.searchsorted(ta, keep) + np.arange(n_ts)
+    shape = keep.shape[:-1] + (len(ta) + n_ts,)
+    res = np.empty(shape, dtype=ts.dtype)
+    is_ts = np.zeros(shape, dtype=bool)
+    np.put_along_axis(res, pos, keep, axis=-1)
+    np.put_along_axis(is_ts, pos, True, axis=-1)
+    res[~is_ts] = np.broadcast_to(ta, shape[:-1] + ta.shape).ravel()
+    return res
+
 def sps(
     pi: np.ndarray, 
     n: int, 
@@ -75,8 +117,9 @@ def sps(
         Sample size.
     prn : np.ndarray, optional
         Permanent random numbers. Should be a flat array of values
-        distributed uniform between 0 and 1. The default does not 
-        use permanent random numbers.
+        distributed uniform between 0 and 1. A 2-D array draws one
+        sample for each row. The default does not use permanent
+        random numbers.
     rng : np.random.Generator, optional
         Random-number generator. The default is 
         np.random.default_rng().
@@ -84,36 +127,90 @@ def sps(
     Returns
     -------
     np.ndarray
-        Indexes for units in the sample.
+        Indexes for units in the sample, or a 2-D array with the
+        indexes for each sample if prn is a 2-D array.
         
     Examples
     --------
     >>> sps(pi([1, 3, 30, 100], 3), 3)
     array([0, 2, 3])
     """
-    pi = np.asfarray(pi).ravel()
+    pi = _as_f64_flat(pi)
     ts = pi < 1
     ta, ts = np.flatnonzero(~ts), np.flatnonzero(ts)
     n_ts = n - len(ta)
-    if n_ts == 0:
-        return np.sort(ta)
+    if n_ts < 0:
+        raise ValueError(
+            f"n must be at least the number of units with pi == 1 ({len(ta)})"
+        )
     if prn is None:
+        if n_ts == 0:
+            return ta
         prn = rng.uniform(size=len(pi))
     else:
-        prn = np.asfarray(prn).ravel()
-    keep = np.argpartition(prn[ts] / pi[ts], n_ts)[:n_ts]
-    return np.sort(np.concatenate([ta, ts[keep]]))
+        prn = np.asarray(prn, dtype=np.float64)
+        if prn.ndim < 2:
+            prn = _as_f64_flat(prn)
+    # Fancy indexing makes a copy, so the division can be done in place
+    ratio = prn[..., ts]
+    ratio /= pi[ts]
+    return _sps_core(ratio, n_ts, ta, ts)
 
 def ps(
     pi: np.ndarray, 
     prn: np.ndarray = None,
     rng: np.random.Generator = np.random.default_rng()
 ) -> np.ndarray:
+    pi = _as_f64_flat(pi)
     if prn is None:
         prn = rng.uniform(size=len(pi))
     else:
-        prn = np.asfarray(prn).ravel()
-    return np.sort(np.flatnonzero(prn < pi))
+        prn = _as_f64_flat(prn)
+    # flatnonzero() already gives the indexes in order
+    return np.flatnonzero(prn < pi)
+
+class PoissonSampler:
+    """
+    Draw repeated Poisson samples, reusing the same buffers for the random
+    numbers and the sample indicators with each draw.
+
+    Parameters
+    ----------
+    pi : np.ndarray
+        Inclusion probabilities. Should be a flat array of values
+        between 0 and 1.
+    rng : np.random.Generator, optional
+        Random-number generator. The default is 
+        np.random.default_rng().
+
+    Examples
+    --------
+    >>> sampler = PoissonSampler(pi([1, 3, 30, 100], 3))
+    >>> sampler()
+    array([1, 2, 3])
+    """
+    def __init__(
+        self,
+        pi: np.ndarray,
+        rng: np.random.Generator = np.random.default_rng()
+    ):
+        self.pi = _as_f64_flat(pi)
+        self.rng = rng
+        self._prn = np.empty(len(self.pi))
+        self._mask = np.empty(len(self.pi), dtype=bool)
+
+    def __call__(self) -> np.ndarray:
+        """
+        Draw a Poisson sample.
+
+        Returns
+        -------
+        np.ndarray
+            Indexes for units in the sample.
+        """
+        self.rng.random(out=self._prn)
+        np.less(self._prn, self.pi, out=self._mask)
+        return np.flatnonzero(self._mask)
 
 def allocate(
     x: dict, 
@@ -122,24 +219,92 @@ def allocate(
     upper: dict = None, 
     d: Callable[[int], float] = lambda a: a + 1
 ) -> Counter:
-    res = Counter(dict.fromkeys(x, 0))
-    lower = Counter(lower)
-    if upper is None:
-        upper = Counter(dict.fromkeys(x, n))
-    else:
-        upper = Counter(upper)
-    if lower > upper:
-        raise ValueError()
-    if lower.total() > n:
-        raise ValueError()
-    if upper.total() < n:
-        raise ValueError()
-    for k in res:
-        res[k] = lower[k]
-    n -= res.total()
-    while n > 0:
-        div = {k: x[k] / d(a) for k, a in res.items() if upper[k] > a}
-        i = max(div.keys(), key=div.get)
+    keys = list(x)
+    lower = dict.fromkeys(keys, 0) if lower is None else lower
+    upper = dict.fromkeys(keys, n) if upper is None else upper
+    res = [lower.get(k, 0) for k in keys]
+    cap = [upper.get(k, 0) for k in keys]
+    if any(a > b for a, b in zip(res, cap)):
+        raise ValueError("lower cannot be larger than upper")
+    remaining = n - sum(res)
+    if remaining < 0:
+        raise ValueError("lower cannot sum to more than n")
+    if sum(cap) < n:
+        raise ValueError("upper cannot sum to less than n")
+    xs = np.fromiter((x[k] for k in keys), dtype=np.float64, count=len(keys))
+    res, cap = np.array(res, dtype=np.int64), np.array(cap, dtype=np.int64)
+    def average(x, a):
+        div = d(a)
+        return x / div if div > 0 else inf
+    # Only the unit that gets the next seat changes its average, so keep
+    # the averages in an array and update one per seat
+    div = np.fromiter(map(average, xs, res), dtype=np.float64, count=len(keys))
+    div[res >= cap] = -inf
+    while remaining > 0:
+        i = np.argmax(div)
         res[i] += 1
-        n -= 1
-    return res
\ No newline at end of file
+        remaining -= 1
+        div[i] = average(xs[i], res[i]) if cap[i] > res[i] else -inf
+    return Counter(dict(zip(keys, res.tolist())))
+
+if __name__ == "__main__":
+    # Tests for pi()
+    assert np.allclose(pi([1, 3, 30, 100], 3), [0.25, 0.75, 1, 1])
+    # Capping 1000 makes 60 too big, which then makes 50 too big
+    x = [1, 2, 3, 50, 60, 1000]
+    assert np.allclose(pi(x, 4), [1 / 6, 2 / 6, 3 / 6, 1, 1, 1])
+    assert np.isclose(pi(x, 4).sum(), 4)
+    # Ties among the largest units
+    assert np.allclose(pi([1, 1, 100, 100], 3), [0.5, 0.5, 1, 1])
+    
+    # Tests for sps()
+    p = pi([1, 3, 30, 100], 3)
+    assert np.array_equal(sps(p, 3, [0.1, 0.9, 0.5, 0.2]), [0, 2, 3])
+    # Every take-some unit is selected
+    assert np.array_equal(sps(np.array([0.5, 0.5]), 2, [0.3, 0.1]), [0, 1])
+    # Each row of a 2-D prn is a separate sample
+    P = np.random.default_rng(1234).uniform(size=(5, 4))
+    for r in range(len(P)):
+        assert np.array_equal(sps(p, 3, P)[r], sps(p, 3, P[r]))
+    # Mix of take-all and take-some units
+    p = np.array([1, 0.5, 1, 0.5])
+    prn = np.array([0.2, 0.4, 0.1, 0.3])
+    assert np.array_equal(sps(p, 3, prn), [0, 2, 3])
+    assert np.array_equal(sps(p, 3, np.vstack([prn, prn[::-1]])),
+                          [[0, 2, 3], [0, 1, 2]])
+    assert np.array_equal(sps(p, 2, prn), [0, 2])
+    try:
+        sps(p, 1)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected a ValueError")
+
+    # Tests for ps() and PoissonSampler
+    p = np.array([0.2, 0.5, 0.9, 0.1])
+    prn = np.array([0.3, 0.4, 0.9, 0.05])
+    assert np.array_equal(ps(p, prn), np.flatnonzero(prn < p))
+    assert np.array_equal(ps(p, prn), [1, 3])
+    
+    sampler = PoissonSampler([0, 1, 1, 0])
+    assert np.array_equal(sampler(), [1, 2])
+    # The buffers are reused, so repeated calls must not leak state
+    assert np.array_equal(sampler(), sampler())
+
+    # Tests for allocate()
+    # Units with a zero divisor get a seat before anyone gets a second one
+    assert allocate({"a": 1, "b": 2, "c": 0}, 3, d=lambda a: a) == \
+        {"a": 1, "b": 1, "c": 1}
+    assert allocate({"a": 6, "b": 6, "c": 2}, 10) == {"a": 5, "b": 4, "c": 1}
+    assert allocate(
+        {"a": 6, "b": 6, "c": 2}, 10,
+        lower={"c": 3}, upper={"a": 3, "b": 9, "c": 9}
+    ) == {"a": 3, "b": 4, "c": 3}
+    try:
+        allocate({"a": 1, "b": 2}, 3, lower={"a": 2}, upper={"a": 1})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected a ValueError")
+    
+    print("Passing all tests.")
@@ -7,21 +7,136 @@ Steve Martin
 
 __all__ = ["balanced_urn", "uniform_urn", "expected_coverage"]
 
-from math import exp, prod, fsum, lgamma, comb
-from itertools import repeat
-from operator import gt
+from collections import Counter
+from math import fsum, lgamma, perm, prod
+import numpy as np
+
+# Only tabulate log factorials up to this size; the table would take too
+# much memory and lose accuracy from the cumulative sum for larger urns
+_lf_max = 4096
+_lf = np.zeros(1)
+
+def _lfact(n: int) -> np.ndarray:
+    # Table of log(k!) for k = 0, ..., n (at least), so that lgamma() at 
+    # the integers is an array lookup; the table is kept between calls and
+    # doubles in size when it needs to grow, but never past _lf_max
+    global _lf
+    if n > _lf_max:
+        raise ValueError(f"n cannot be larger than {_lf_max}")
+    lf = _lf
+    if len(lf) <= n:
+        k = np.arange(len(lf), min(max(n + 1, 2 * len(lf)), _lf_max + 1))
+        lf = np.concatenate([lf, lf[-1] + np.cumsum(np.log(k))])
+        _lf = lf
+    return lf
+
+def _lgamma1(x: np.ndarray) -> np.ndarray:
+    # log(x!) for an array of non-negative integers, from the table when
+    # the arguments are small enough, otherwise with lgamma() evaluated 
+    # once for each distinct value
+    m = x.max(initial=0)
+    if m <= _lf_max:
+        return _lfact(m)[x]
+    val, pos = np.unique(x, return_inverse=True)
+    res = np.array([lgamma(v + 1) for v in val.tolist()])
+    return res[pos].reshape(x.shape)
 
 # Analogous to R's lchoose()
-def _lperm(n: int, k: int) -> float:
-    return lgamma(n + 1) - lgamma(n - k + 1)
+def _lperm(n: np.ndarray, k: np.ndarray) -> np.ndarray:
+    return _lgamma1(n) - _lgamma1(n - k)
+
+def _falling_ratio(n: np.ndarray, N: int, k: int) -> np.ndarray:
+    # n(n - 1)...(n - k + 1) / N(N - 1)...(N - k + 1), which is 0 when 
+    # n < k
+    i = np.arange(k)
+    return np.prod((n[:, None] - i) / (N - i), axis=1)
+
+def _coverage_replace(urn: np.ndarray, 
+                      count: np.ndarray,
+                      balls: np.ndarray, 
+                      draws: np.ndarray) -> float:
+    # Sampling with replacement; add the logs across urns so that each row
+    # needs a single exp
+    # log1p(-1) = -inf for a color that fills an urn, and urns with no draws
+    # (including empty urns) give 0 * -inf or 0 / 0, which are masked
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lp = np.where(draws > 0, draws * np.log1p(-urn / balls), 0)
+    return float(count @ -np.expm1(lp.sum(axis=1)))
 
-def _urn_matrix(*urns: dict[str, int]) -> dict[str, list]:
+def _coverage_exact(urn: np.ndarray, 
+                    count: np.ndarray,
+                    balls: np.ndarray, 
+                    draws: np.ndarray) -> float:
+    # Sampling without replacement with Python's integers
+    # C(balls - color, n) / C(balls, n) is a ratio of falling factorials,
+    # so the n! in both binomial coefficients is skipped; the same number
+    # of balls often turns up for many colors in an urn, so only compute
+    # the numerator once for each distinct number of balls in each urn
+    balls, draws = balls.tolist(), draws.tolist()
+    cache = [{color: perm(b - color, n) for color in set(u)}
+             for u, b, n in zip(urn.T.tolist(), balls, draws)]
+    # Multiply the integer ratios across urns and divide once at the end,
+    # so that the complement for each row is correctly rounded
+    den = prod(map(perm, balls, draws))
+    res = []
+    for row, k in zip(urn.tolist(), count.tolist()):
+        num = 1
+        for color, pj in zip(row, cache):
+            num *= pj[color]
+            # Stop as soon as there is no chance of missing the color
+            if num == 0:
+                break
+        res.append(k * (den - num) / den)
+    return fsum(res)
+
+def _coverage_float(urn: np.ndarray, 
+                    count: np.ndarray,
+                    balls: np.ndarray, 
+                    draws: np.ndarray) -> float:
+    # Floating-point approximation for sampling without replacement,
+    # vectorized over the colors in each urn
+    # A direct product is faster and more accurate than going through 
+    # log factorials for a small number of draws
+    small = 64
+    if draws.max(initial=0) > small:
+        den = _lperm(balls, draws)
+    p = np.ones(len(urn))
+    for j, (u, b, n) in enumerate(zip(urn.T, balls, draws)):
+        # Every color is missed with certainty when there are no draws, and
+        # colors that aren't in the urn are always missed, so only work with
+        # the colors in the urn (e.g., urns with disjoint colors only touch
+        # their own colors)
+        if n == 0:
+            continue
+        has = np.flatnonzero(u)
+        u = u[has]
+        if n <= small:
+            p[has] *= _falling_ratio(b - u, b, n)
+            continue
+        # No chance of missing a color when there are fewer balls of other 
+        # colors than draws; clamp these cells to keep the lookup in range,
+        # then send them to exp(-inf) = 0 so that exp runs on the whole
+        # column without a branch
+        other = b - u
+        lp = _lperm(np.maximum(other, n), n) - den[j]
+        p[has] *= np.exp(np.where(other >= n, lp, -np.inf))
+    # Take the complements before summing, rather than subtracting the sum
+    # of p from the number of colors, to avoid cancellation
+    return float(count @ (1 - p))
+
+def _urn_matrix(*urns: dict[str, int], dtype=np.int64) -> np.ndarray:
     # {'red': 1, 'blue': 2, 'green': 3}        red 1 4 6
     # {'red': 4, 'green': 5}             =>   blue 2 0 7
     # {'red': 6, 'blue': 7}                  green 3 5 0
 
-    colors = set().union(*urns)
-    return {c: [u.get(c, 0) for u in urns] for c in colors}
+    # Fill in the rows in one pass over the urns, keeping the colors in the
+    # order they first appear
+    rows = {}
+    for j, u in enumerate(urns):
+        for c, x in u.items():
+            rows.setdefault(c, [0] * len(urns))[j] = x
+    urn = np.array(list(rows.values()), dtype=dtype)
+    return urn.reshape(len(rows), len(urns))
 
 def balanced_urn(balls: int, colors: set[str]) -> dict[str, int]:
     """
@@ -57,8 +172,8 @@ def balanced_urn(balls: int, colors: set[str]) -> dict[str, int]:
             "there must be colors for the urn"
             )
     k = balls // n
-    r = balls - k * n # 0 <= d < n
-    return dict(zip(colors, [k + 1]*r + [k]*(n - r)))
+    r = balls - k * n # 0 <= r < n
+    return {c: k + 1 if i < r else k for i, c in enumerate(colors)}
 
 def uniform_urn(balls: int, colors: set[str]) -> dict[str, int]:
     """
@@ -117,8 +232,10 @@ def expected_coverage(draws: list[int],
         Is sampling done with replacement? The default is False.
     exact : bool, optional
         If True, use Python's arbitrary-precision integers for calculating the
-        ratio of binomial coefficients when replace=False. If False, use a 
-        faster floating-point approximation. The default is False.
+        ratio of binomial coefficients when replace=False, and add up the
+        colors with compensated summation; this also works for urns with 
+        2**63 or more balls. If False, use a faster floating-point 
+        approximation. The default is False.
 
     Returns
     -------
@@ -140,37 +257,48 @@ def expected_coverage(draws: list[int],
         raise ValueError(
             "number of draws does not equals the number of urns"
             )
-    balls = [sum(u.values()) for u in urns]
-    if any(map(gt, draws, balls)) and not replace:
+    # Keep Python's integers for the exact calculation so that very large
+    # urns don't overflow int64
+    dtype = object if exact and not replace else np.int64
+    balls = np.array([sum(u.values()) for u in urns], dtype=dtype)
+    draws = np.array([int(n) for n in draws], dtype=dtype)
+    if not replace and np.any(draws > balls):
         raise ValueError(
             "cannot draw more balls than are in the urns without replacement"
             )
-    urn = _urn_matrix(*urns)
-    # Function that gives probability of drawing no balls of a given color
-    # Precompute the denominators for each urn for efficiency
-    if replace:
-        den = repeat(None)
-        def p(color, balls, n, den): # den is a dummy argument
-            return (1 - color / balls)**n
+    if replace and np.any((draws > 0) & (balls == 0)):
+        raise ValueError(
+            "cannot draw balls from an empty urn"
+            )
+    urn = _urn_matrix(*urns, dtype=dtype)
+    # Colors with the same number of balls in each urn are equally likely
+    # to be drawn, so only do the calculation for each distinct row
+    if len(urns) == 1:
+        # Much faster than finding unique rows for the common case of one urn
+        urn, count = np.unique(urn, return_counts=True)
+        urn = urn.reshape(-1, 1)
+    elif urn.dtype == object:
+        # np.unique() can't find the distinct rows of an object array
+        rows = Counter(map(tuple, urn.tolist()))
+        urn = np.array(list(rows), dtype=object).reshape(len(rows), len(urns))
+        count = np.fromiter(rows.values(), dtype=np.int64, count=len(rows))
     else:
-        if exact:
-            den = list(map(comb, balls, draws))
-            def p(color, balls, n, den):
-                return comb(balls - color, n) / den
-        else:
-            den = list(map(_lperm, balls, draws))
-            def p(color, balls, n, den):
-                if balls - color + 1 > n:
-                    return exp(_lperm(balls - color, n) - den)
-                else:
-                    return 0.0
-    # Apply over each urn to get the probability of drawing no balls of a
-    # given color across all urns, and add the complements to get the
+        urn, count = np.unique(urn, axis=0, return_counts=True)
+    # Store the urns in columns, as the calculations go one urn at a time
+    urn = np.asfortranarray(urn)
+    # Find the probability of drawing no balls of a given color from each
+    # urn, then add the complements of the products across urns to get the
     # expected number of different colors
-    return fsum(1 - prod(map(p, urn[c], balls, draws, den)) for c in urn)
+    if replace:
+        coverage = _coverage_replace
+    elif exact:
+        coverage = _coverage_exact
+    else:
+        coverage = _coverage_float
+    return coverage(urn, count, balls, draws)
         
 if __name__ == "__main__":
-    from math import isclose
+    from math import isclose, comb
     
     # Tests for balanced_urn()
     assert balanced_urn(0, range(1)) == {0: 0}
@@ -261,6 +389,44 @@ if __name__ == "__main__":
     assert isclose(expected_coverage([3, 2, 4], urn3, urn2, urn4, replace=True),
                    3.4654180416477)
     
+    # Vectorized paths agree with the exact path on larger urns
+    urn5 = uniform_urn(465, range(30))
+    assert isclose(expected_coverage([40, 3], urn5, urn3),
+                   expected_coverage([40, 3], urn5, urn3, exact=True))
+    assert isclose(expected_coverage([40, 0], urn5, urn3),
+                   expected_coverage([40], urn5, exact=True))
+    
+    # More than 64 draws goes through log factorials, and "a" can't be
+    # missed from the first urn
+    urn6 = {"a": 100, "b": 10, "c": 1}
+    assert isclose(expected_coverage([95, 70], urn6, urn5),
+                   expected_coverage([95, 70], urn6, urn5, exact=True))
+    assert isclose(expected_coverage([95], urn6), 
+                   expected_coverage([95], urn6, exact=True))
+    
+    # Drawing from an empty urn
+    try:
+        expected_coverage([1], {"a": 0}, replace=True)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected a ValueError")
+    assert isclose(expected_coverage([0, 1], {"a": 0}, {"b": 1}, replace=True), 1)
+    
+    # Urns too big for the table of log factorials
+    for big in [2**20, 2**40]:
+        assert isclose(expected_coverage([100], {"a": big, "b": 5}),
+                       expected_coverage([100], {"a": big, "b": 5}, exact=True))
+    assert isclose(expected_coverage([65], {"a": 10**7, "b": 7, "c": 3}),
+                   expected_coverage([65], {"a": 10**7, "b": 7, "c": 3}, exact=True),
+                   rel_tol=1e-8)
+    
+    # Urns too big for int64
+    assert isclose(expected_coverage([3], {"a": 2**63, "b": 5}, exact=True), 1)
+    assert isclose(expected_coverage([3, 1], {"a": 2**64, "b": 5}, 
+                                     {"a": 1, "c": 2**70}, exact=True), 
+                   1 + 1 - 1 / (2**70 + 1))
+    
     # Simulation to help verify
     # from random import sample, choices
     # from statistics import mean